@@ -1,148 +1,165 @@
-from dash import Dash, dcc, html, Input, Output, callback
+from dash import Dash, dcc, html, Input, Output, State, callback
 from dash.exceptions import PreventUpdate
+from flask_caching import Cache
+from flask_compress import Compress
 from retry_requests import retry
 import dash_leaflet as dl
 import dash_daq as daq
 import datetime as dt
-from datetime import timedelta
+import functools
+import json
 import numpy as np
 import openmeteo_requests
 import pandas as pd
 import plotly.express as px
-import plotly.graph_objects as go
+import plotly.io as pio
 import requests
 import requests_cache
+import threading
+import time
+
+# Dash encodes callback responses with Plotly's JSON encoder, so this switches
+# both figures and callback payloads to orjson (numpy arrays are encoded in C)
+pio.json.config.default_engine = "orjson"
+
+# Static popup labels, built once and reused by every callback
+_BOLD = {"fontWeight": "bold"}
+_LOCATION_LABEL = html.Span("Location: ", style=_BOLD)
+_COORDINATES_LABEL = html.Span("Coordinates: ", style=_BOLD)
+_ELEVATION_LABEL = html.Span("Elevation: ", style=_BOLD)
+_TEMPERATURE_LABEL = html.Span("Temperature: ", style=_BOLD)
+_PRECIP_LABEL = html.Span("Precip. Probability: ", style=_BOLD)
+
+# Shared by the humidity and precipitation gauges
+GAUGE_RANGES = {
+    "gradient": True,
+    "ranges": {"#a6e3a1": [0, 33], "#f9e2af": [33, 66], "#f38ba8": [66, 100]},
+}
 
 colorscale = ["black", "lightblue", "blue", "green", "yellow", "red", "white"]
 
 app = Dash(__name__)
+# Expose the Flask server for WSGI servers (e.g. `gunicorn app:server`)
+server = app.server
+# gzip/brotli compress callback responses
+Compress(server)
+# Share computed dashboards between users asking for the same place and hour
+cache = Cache(
+    server, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 600}
+)
 
+# Setup the Open-Meteo API client with cache and retry on error once, so every
+# callback reuses the same cache and connection pool. The caches are in-memory
+# per worker to avoid sqlite file-lock contention between gunicorn workers.
+_CACHE = requests_cache.CachedSession(backend="memory", expire_after=3600)
+_RETRY = retry(_CACHE, retries=5, backoff_factor=0.2)
+_OPENMETEO = openmeteo_requests.Client(session=_RETRY)
 
-def get_local_time(latitude, longitude):
-    # Prepare the API request
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "current_weather": True,
-        "timezone": "auto",
-    }
+# The memory backend never evicts on its own, see _purge_expired_responses()
+_last_purge = time.monotonic()
+_purge_lock = threading.Lock()
 
-    # Send the request to Open-Meteo
-    response = requests.get(url, params=params)
-    data = response.json()
+# Plain keep-alive session for the geocoding API; _geocode() caches the results
+_GEO_SESSION = requests.Session()
 
-    # Print the full JSON response to inspect its structure
-    # print("API Response:", data)
 
+def _purge_expired_responses():
+    # Drop expired forecasts at most once an hour so the cache doesn't grow
+    # with every location looked up over the life of the worker
+    global _last_purge
+    # Only one thread purges; the others skip rather than wait
+    if not _purge_lock.acquire(blocking=False):
+        return
     try:
-        # Assuming the correct key once identified from the printed response
-        time_str = data["current_weather"]["time"]
-        local_time = dt.datetime.strptime(time_str, "%Y-%m-%dT%H:%M")
-        timezone_offset_seconds = data["utc_offset_seconds"]
-        timezone_offset = timedelta(seconds=timezone_offset_seconds)
+        if time.monotonic() - _last_purge >= 3600:
+            _CACHE.cache.delete(expired=True)
+            _last_purge = time.monotonic()
+    except RuntimeError:
+        # Another thread stored a response while the cache was being scanned;
+        # skip this purge and retry on the next request
+        pass
+    finally:
+        _purge_lock.release()
+
+
+@functools.lru_cache(maxsize=512)
+def _geocode(name):
+    geocode_url = "https://geocoding-api.open-meteo.com/v1/search"
+    # Let requests encode the name so "&", "#" or "+" can't break the query
+    params = {"name": name, "count": 1, "language": "en", "format": "json"}
+    response = _GEO_SESSION.get(geocode_url, params=params, timeout=5)
+    results = response.json().get("results")
+    # The API omits "results" entirely when nothing matches
+    if not results:
+        return None
+    result = results[0]
+    # admin1 (state/region) and country are omitted for some places
+    return (
+        result["latitude"],
+        result["longitude"],
+        result["name"],
+        result.get("admin1"),
+        result.get("country"),
+    )
 
-        # Get the local UTC time and add the timezone offset
-        local_time = local_time - timezone_offset
 
-        return local_time
-    except KeyError as e:
-        return f"KeyError - {str(e)}: Check your data structure."
+_DIRS = (
+    "North",
+    "Northeast",
+    "East",
+    "Southeast",
+    "South",
+    "Southwest",
+    "West",
+    "Northwest",
+)
+_DIRS_ARR = np.array(_DIRS)
+_UNKNOWN_DIRECTION = "Unknown Direction"
 
 
 def degrees_to_direction(degrees):
-    if degrees < 0 or degrees > 360:
-        return "Invalid degree input. Degrees must be between 0 and 360."
-
-    # Normalize degrees to be within 0-360
-    degrees = degrees % 360
-
-    if (degrees >= 0 and degrees < 22.5) or (degrees >= 337.5 and degrees <= 360):
-        return "North"
-    elif degrees >= 22.5 and degrees < 67.5:
-        return "Northeast"
-    elif degrees >= 67.5 and degrees < 112.5:
-        return "East"
-    elif degrees >= 112.5 and degrees < 157.5:
-        return "Southeast"
-    elif degrees >= 157.5 and degrees < 202.5:
-        return "South"
-    elif degrees >= 202.5 and degrees < 247.5:
-        return "Southwest"
-    elif degrees >= 247.5 and degrees < 292.5:
-        return "West"
-    elif degrees >= 292.5 and degrees < 337.5:
-        return "Northwest"
+    if np.ndim(degrees):
+        degrees = np.asarray(degrees)
+        # Open-Meteo reports missing values as NaN; zero them for the index math
+        missing = np.isnan(degrees)
+        # Shift by half a sector so North covers 337.5-22.5, then index the sector
+        index = ((np.where(missing, 0, degrees) % 360 + 22.5) // 45).astype(int) % 8
+        return np.where(missing, _UNKNOWN_DIRECTION, _DIRS_ARR[index])
+
+    # Open-Meteo reports missing values as NaN
+    if np.isnan(degrees):
+        return _UNKNOWN_DIRECTION
+    # Shift by half a sector so North covers 337.5-22.5, then index the 45° sector
+    return _DIRS[int((degrees % 360 + 22.5) // 45) % 8]
+
+
+@functools.lru_cache(maxsize=128)
+def wind_direction_compass(direction_degrees):
+    # Meteorological direction is where the wind comes from, so point a down
+    # arrow (blowing away from North at 0°) and rotate it clockwise into place.
+    # None means the direction is missing, so leave the arrow unrotated.
+    if direction_degrees is None:
+        direction, rotation = _UNKNOWN_DIRECTION, 0
     else:
-        return "Unknown Direction"
-
-
-def wind_direction_arrow(direction_degrees, length=1):
-    # Convert degrees to radians for trigonometric calculations
-    direction_radians = np.deg2rad(direction_degrees)
-
-    # Calculate arrow components
-    dx = length * np.sin(direction_radians)
-    dy = length * np.cos(direction_radians)
-
-    # Create a plotly figure
-    fig = go.Figure()
-
-    # Add an arrow using annotations
-    fig.add_annotation(
-        x=0,
-        y=0,
-        ax=dx,
-        ay=dy,
-        xref="x",
-        yref="y",
-        axref="x",
-        ayref="y",
-        showarrow=True,
-        arrowhead=2,
-        arrowsize=1,
-        arrowwidth=2,
-        arrowcolor="#f38ba8",
-    )
-
-    # Set plot limits and layout options
-    fig.update_xaxes(range=[-1.5, 1.5], showgrid=False, zeroline=False, visible=False)
-    fig.update_yaxes(range=[-1.5, 1.5], showgrid=False, zeroline=False, visible=False)
-
-    fig.update_layout(
-        title={
-            "text": f"Wind Direction: {degrees_to_direction(direction_degrees)}",
-            "x": 0.5,
-            "y": 1,
-            "xanchor": "center",
-            "yanchor": "top",
-        },
-        plot_bgcolor="rgba(0,0,0,0)",
-        paper_bgcolor="rgba(0,0,0,0)",
-        showlegend=False,
-        font=dict(family="sans-serif", color="#89b4fa"),
-        xaxis=dict(showgrid=False, zeroline=False),
-        yaxis=dict(showgrid=False, zeroline=False),
-        width=400,
-        height=400,
-        margin={"l": 20, "r": 20, "t": 50, "b": 20},
+        direction, rotation = degrees_to_direction(direction_degrees), direction_degrees
+    return html.Div(
+        [
+            html.Div(
+                "Wind Direction: " + direction,
+                style={"fontFamily": "sans-serif", "color": "#89b4fa"},
+            ),
+            html.Div(
+                "↓",
+                style={
+                    "transform": f"rotate({rotation}deg)",
+                    "fontSize": "96px",
+                    "color": "#f38ba8",
+                },
+            ),
+        ],
+        style={"textAlign": "center"},
     )
 
-    return fig
-
-
-def format_12hr(time_str):
-    # Extract hours and minutes
-    hour, minute = map(int, time_str.split(":"))
-    # Apply modulo 12 to get the hour in 12-hour format
-    hour_12 = hour % 12
-    # Adjust hour from '0' to '12' for 12 AM and 12 PM
-    hour_12 = 12 if hour_12 == 0 else hour_12
-    # Determine AM/PM
-    am_pm = "AM" if hour < 12 else "PM"
-    # Return formatted time
-    return f"{hour_12}:{minute:02d} {am_pm}"
-
 
 app.layout = html.Div(
     [
@@ -163,6 +180,8 @@ app.layout = html.Div(
                     debounce=True,
                 ),
                 html.Button("Submit", id="submit-btn"),
+                dcc.Store(id="geocoded-coords"),
+                dcc.Store(id="last-query"),
                 html.Div(
                     style={"visibility": "hidden"},
                     id="map-container",
@@ -197,15 +216,45 @@ app.layout = html.Div(
                             zoom=8,
                             style={"height": "50vh"},
                         ),
-                    ],
-                ),
-                html.Div(
-                    style={"display": "flex", "justifyContent": "space-around"},
-                    children=[
-                        html.Div(id="humidity-gauge"),
-                        html.Div(id="precip-gauge"),
-                        html.Div(id="thermometer"),
-                        html.Div(id="compass"),
+                        # The gauges live in the layout (hidden with the map) so
+                        # the callback only has to update their values
+                        html.Div(
+                            style={
+                                "display": "flex",
+                                "justifyContent": "space-around",
+                            },
+                            children=[
+                                daq.Gauge(
+                                    id="humidity-gauge",
+                                    color=GAUGE_RANGES,
+                                    showCurrentValue=True,
+                                    value=0,
+                                    label="Humidity (%)",
+                                    max=100,
+                                    min=0,
+                                ),
+                                daq.Gauge(
+                                    id="precip-gauge",
+                                    color=GAUGE_RANGES,
+                                    showCurrentValue=True,
+                                    value=0,
+                                    label="Precip. Probability (%)",
+                                    max=100,
+                                    min=0,
+                                ),
+                                daq.Thermometer(
+                                    id="thermometer",
+                                    height=140,
+                                    min=-50,
+                                    max=135,
+                                    value=0,
+                                    showCurrentValue=True,
+                                    color="#f38ba8",
+                                    label="Temperature (ºF)",
+                                ),
+                                html.Div(id="compass"),
+                            ],
+                        ),
                     ],
                 ),
                 html.Div(
@@ -222,44 +271,55 @@ app.layout = html.Div(
 
 @callback(
     [
-        Output("map", "center"),
-        Output("marker", "position"),
+        Output("geocoded-coords", "data"),
         Output("pop-up", "children"),
         Output("map-container", "style"),
-        Output("humidity-gauge", "children"),
-        Output("precip-gauge", "children"),
-        Output("thermometer", "children"),
+        Output("humidity-gauge", "value"),
+        Output("precip-gauge", "value"),
+        Output("thermometer", "value"),
         Output("compass", "children"),
         Output("time-series-chart", "children"),
+        Output("last-query", "data"),
     ],
     Input("location", "value"),
+    State("last-query", "data"),
     prevent_initial_call=True,
 )
-def update_output(location):
-    if not location:
+def update_output(location, last_query):
+    # Skip empty and too-short input, which can't geocode to anything useful
+    if not location or len(location.strip()) < 3:
         raise PreventUpdate
 
-    geocode_url = f"https://geocoding-api.open-meteo.com/v1/search?name={location}&count=1&language=en&format=json"
-    res = requests.get(geocode_url).json()
-    lat = res["results"][0]["latitude"]
-    lon = res["results"][0]["longitude"]
-
+    location = location.strip().lower()
     now = dt.datetime.now(dt.timezone.utc)
+    hour_bucket = now.strftime("%Y%m%d%H")
+    query = f"{location}|{hour_bucket}"
+    # Nothing to refresh if the normalized query hasn't changed this hour
+    if query == last_query:
+        raise PreventUpdate
+
+    return _compute(location, hour_bucket, now) + (query,)
+
 
-    new_center = [lat, lon]
-    new_position = [lat, lon]
+# Key only on location and hour; now is the instant hour_bucket was taken from
+@cache.memoize(args_to_ignore=["now"])
+def _compute(location, hour_bucket, now):
+    geocoded = _geocode(location)
+    if geocoded is None:
+        raise PreventUpdate
+    lat, lon, name, admin1, country = geocoded
+
+    coords = [lat, lon]
     popup_content = [
         html.Div(
             [
-                html.Span("Location: ", style={"fontWeight": "bold"}),
-                html.Span(
-                    f"{res['results'][0]['name']}, {res['results'][0]['admin1']}, {res['results'][0]['country']}"
-                ),
+                _LOCATION_LABEL,
+                html.Span(", ".join(filter(None, (name, admin1, country)))),
             ]
         ),
         html.Div(
             [
-                html.Span("Coordinates: ", style={"fontWeight": "bold"}),
+                _COORDINATES_LABEL,
                 html.Span(f"{lat}°, {lon}°"),
             ]
         ),
@@ -268,11 +328,6 @@ def update_output(location):
         "visibility": "visible",
     }
 
-    # Setup the Open-Meteo API client with cache and retry on error
-    cache_session = requests_cache.CachedSession(".cache", expire_after=3600)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-
     # Make sure all required weather variables are listed here
     # The order of variables in hourly or daily is important to assign them correctly below
     forecast_url = "https://api.open-meteo.com/v1/forecast"
@@ -292,14 +347,15 @@ def update_output(location):
         "timezone": "auto",
         "forecast_days": 1,
     }
-    responses = openmeteo.weather_api(forecast_url, params=params)
+    _purge_expired_responses()
+    responses = _OPENMETEO.weather_api(forecast_url, params=params, timeout=5)
 
     # Process first location. Add a for-loop for multiple locations or weather models
     response = responses[0]
     popup_content.append(
         html.Div(
             [
-                html.Span("Elevation: ", style={"fontWeight": "bold"}),
+                _ELEVATION_LABEL,
                 html.Span(f"{response.Elevation()}m asl"),
             ]
         ),
@@ -313,12 +369,15 @@ def update_output(location):
     hourly_wind_speed_10m = hourly.Variables(3).ValuesAsNumpy()
     hourly_wind_direction_10m = hourly.Variables(4).ValuesAsNumpy()
 
+    # Build the timestamps with a plain arange over the epoch seconds rather
+    # than going through pd.date_range
     hourly_data = {
-        "date": pd.date_range(
-            start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-            end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=hourly.Interval()),
-            inclusive="left",
+        "date": pd.to_datetime(
+            np.arange(
+                hourly.Time(), hourly.TimeEnd(), hourly.Interval(), dtype=np.int64
+            ),
+            unit="s",
+            utc=True,
         )
     }
     hourly_data["temperature_2m"] = hourly_temperature_2m
@@ -327,66 +386,51 @@ def update_output(location):
     hourly_data["wind_speed_10m"] = hourly_wind_speed_10m
     hourly_data["wind_direction_10m"] = hourly_wind_direction_10m
 
-    hourly_dataframe = pd.DataFrame(data=hourly_data)
-
-    # print(hourly_dataframe)
-
-    current_hour_data = hourly_dataframe.loc[
-        (hourly_dataframe["date"].dt.hour == now.hour)
-        & (hourly_dataframe["date"].dt.date == now.date())
-    ]
-
-    # print(current_hour_data)
-
-    humidity_gauge = daq.Gauge(
-        color={
-            "gradient": True,
-            "ranges": {"#a6e3a1": [0, 33], "#f9e2af": [33, 66], "#f38ba8": [66, 100]},
-        },
-        showCurrentValue=True,
-        value=current_hour_data["relative_humidity_2m"].values[0],
-        label="Humidity (%)",
-        max=100,
-        min=0,
-    )
+    # The series starts at hourly.Time() with a fixed interval, so the current
+    # hour is a single integer offset into each array
+    current_index = int((now.timestamp() - hourly.Time()) // hourly.Interval())
+    # A cached forecast can be up to an hour old and end just before now (e.g.
+    # right after local midnight), so clamp to the hours it actually covers
+    if not 0 <= current_index < len(hourly_wind_speed_10m):
+        current_index = min(max(current_index, 0), len(hourly_wind_speed_10m) - 1)
+    current_hour_data = {
+        name: values[current_index]
+        for name, values in hourly_data.items()
+        if name != "date"
+    }
 
-    precip_gauge = daq.Gauge(
-        color={
-            "gradient": True,
-            "ranges": {"#a6e3a1": [0, 33], "#f9e2af": [33, 66], "#f38ba8": [66, 100]},
-        },
-        showCurrentValue=True,
-        value=current_hour_data["precipitation_probability"].values[0],
-        label="Precip. Probability (%)",
-        max=100,
-        min=0,
-    )
+    # Bin to 5° so the compass is built at most once per bin (72 in total);
+    # a missing (NaN) direction can't be binned and is passed as None
+    direction = current_hour_data["wind_direction_10m"]
+    if np.isnan(direction):
+        direction_bin = None
+    else:
+        direction_bin = int(round(direction / 5) * 5) % 360
+    compass = wind_direction_compass(direction_bin)
 
-    thermometer = daq.Thermometer(
-        height=140,
-        min=-50,
-        max=135,
-        value=current_hour_data["temperature_2m"].values[0],
-        showCurrentValue=True,
-        color="#f38ba8",
-        label="Temperature (ºF)",
-    )
+    # The chart's x-axis is in UTC, so mark the current UTC instant
+    # Convert to the format expected by Plotly (milliseconds since the Unix epoch)
+    current_time_ms = int(now.timestamp() * 1000)
 
-    compass = dcc.Graph(
-        figure=wind_direction_arrow(current_hour_data["wind_direction_10m"].values[0])
-    )
+    # Only the chart needs the series, so plot the float32 arrays directly
+    # instead of boxing every variable into a DataFrame
+    hourly_dates = hourly_data["date"]
+    wind_speed = hourly_wind_speed_10m
 
-    local_time = get_local_time(lat, lon)
+    # Thin long series (e.g. more forecast days) to ~200 points before plotting
+    # so the figure payload stays bounded by the chart width, not the data size
+    if len(hourly_dates) > 500:
+        step = len(hourly_dates) // 200
+        hourly_dates = hourly_dates[::step]
+        wind_speed = wind_speed[::step]
 
-    # Convert to the format expected by Plotly (milliseconds since the Unix epoch)
-    current_time_ms = int(local_time.timestamp() * 1000)
+    # Label each tick in the location's local time, in 12-hour format
+    local_dates = hourly_dates + pd.Timedelta(seconds=response.UtcOffsetSeconds())
+    ticktext = local_dates.strftime("%I:%M %p").str.lstrip("0").tolist()
 
-    # print(current_hour_data["wind_speed_10m"].values[0])
-    print(hourly_dataframe)
     fig = px.line(
-        hourly_dataframe,
-        x="date",
-        y="wind_speed_10m",
+        x=hourly_dates,
+        y=wind_speed,
     )
     fig.update_traces(
         line=dict(color="#89b4fa"),
@@ -401,18 +445,8 @@ def update_output(location):
             tickformat="%H:%M",
             title_font=dict(size=14),
             tickfont=dict(size=12),
-            tickvals=[
-                pd.Timestamp(d) for d in hourly_dataframe["date"]
-            ],  # Assuming df['date'] is your DataFrame column
-            ticktext=[
-                format_12hr(
-                    (
-                        pd.Timestamp(d)
-                        + timedelta(hours=response.UtcOffsetSeconds() / 3600)
-                    ).strftime("%H:%M")
-                )
-                for d in hourly_dataframe["date"]
-            ],
+            tickvals=hourly_dates.tolist(),
+            ticktext=ticktext,
         ),
         yaxis=dict(
             title_font=dict(size=14),
@@ -440,39 +474,54 @@ def update_output(location):
         xref="x",
     )
     fig.update_xaxes(type="date")
-    wind_speed_fig = dcc.Graph(figure=fig)
+    # Serialize the figure once here so memoized results hold plain JSON data
+    # rather than a Figure that has to be re-encoded on every response
+    wind_speed_fig = dcc.Graph(figure=json.loads(pio.to_json(fig)))
 
     popup_content.append(
         html.Div(
             [
-                html.Span("Temperature: ", style={"fontWeight": "bold"}),
-                html.Span(f"{current_hour_data['temperature_2m'].values[0]}ºF"),
+                _TEMPERATURE_LABEL,
+                html.Span(f"{current_hour_data['temperature_2m']}ºF"),
             ]
         ),
     )
     popup_content.append(
         html.Div(
             [
-                html.Span("Precip. Probability: ", style={"fontWeight": "bold"}),
-                html.Span(
-                    f"{current_hour_data['precipitation_probability'].values[0]}%"
-                ),
+                _PRECIP_LABEL,
+                html.Span(f"{current_hour_data['precipitation_probability']}%"),
             ]
         ),
     )
 
     return (
-        new_center,
-        new_position,
+        coords,
         popup_content,
         new_style,
-        humidity_gauge,
-        precip_gauge,
-        thermometer,
+        current_hour_data["relative_humidity_2m"],
+        current_hour_data["precipitation_probability"],
+        current_hour_data["temperature_2m"],
         compass,
         wind_speed_fig,
     )
 
 
+# Recentering the map is pure prop passing, so do it in the browser
+app.clientside_callback(
+    """
+    function(coords) {
+        return [coords, coords];
+    }
+    """,
+    [
+        Output("map", "center"),
+        Output("marker", "position"),
+    ],
+    Input("geocoded-coords", "data"),
+    prevent_initial_call=True,
+)
+
+
 if __name__ == "__main__":
     app.run(debug=True)